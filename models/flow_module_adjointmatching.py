@@ -22,6 +22,61 @@ from experiments import utils as eu
 from pytorch_lightning.loggers.wandb import WandbLogger
 
 
+def _process_sample(args):
+    """Writes a validation sample to PDB and computes its metrics."""
+    final_pos, sample_dir = args
+    os.makedirs(sample_dir, exist_ok=True)
+    saved_path = au.write_prot_to_pdb(
+        final_pos,
+        os.path.join(sample_dir, 'sample.pdb'),
+        no_indexing=True
+    )
+    mdtraj_metrics = metrics.calc_mdtraj_metrics(saved_path)
+    ca_idx = residue_constants.atom_order['CA']
+    ca_ca_metrics = metrics.calc_ca_ca_metrics(final_pos[:, ca_idx])
+    return saved_path, mdtraj_metrics | ca_ca_metrics
+
+
+def _trans_drift_fn(x, t, pred_trans_1, reward):
+    """Reward-scaled translation drift (x_1 - x) / (1 - t) * reward."""
+    return (pred_trans_1 - x) / (1 - t[..., None]) * reward[..., None, None]
+
+
+def _rot_drift_fn(r, t, pred_rotmats_1, reward):
+    """Reward-scaled rotation drift Log_r(r_1) * reward."""
+    return so3_utils.calc_rot_vf(r, pred_rotmats_1) * reward[..., None, None]
+
+
+def _trans_adjoint_scale(reward, ts, dt: float):
+    """
+    Lean adjoint scale of the translation drift (x_1 - x) / (1 - t) * reward.
+    The drift is linear in x, so the adjoint solves da/dt = reward / (1 - t) * a
+    as a = exp(-reward * int 1 / (1 - t) dt). That integral diverges at t = 1,
+    so the midpoint sum over ts (about 4.9 for 20 timesteps) is used as a
+    regularized stand-in. The result depends on the grid, and the autograd
+    path on the same grid gives the same value.
+    Args:
+        reward: Reward [batch_size]
+        ts: Backward integration timesteps from 1 to 0 [num_steps]
+        dt: Integration step size
+    """
+    t_mids = ts[:-1] + 0.5 * dt
+    return torch.exp(dt * reward * torch.sum(1.0 / (1 - t_mids)))
+
+
+def _rot_adjoint_scale(reward, ts, dt: float):
+    """
+    Lean adjoint scale of the rotation drift Log_r(r_1) * reward linearized
+    at r_1. Writing r = r_1 exp(w) gives Log_r(r_1) = -w, so the adjoint
+    solves da/dt = reward * a and decays exactly as exp(-reward) over [0, 1].
+    Args:
+        reward: Reward [batch_size]
+        ts: Backward integration timesteps from 1 to 0 [num_steps]
+        dt: Integration step size
+    """
+    return torch.exp(dt * (ts.shape[0] - 1) * reward)
+
+
 class FlowModule(LightningModule):
 
     def __init__(self, cfg):
@@ -44,52 +99,102 @@ class FlowModule(LightningModule):
 
         self._checkpoint_dir = None
         self._inference_dir = None
+
+        # Backward integration timesteps of the adjoint ODE
+        num_adj_steps = 20
+        self.register_buffer(
+            '_adj_ts', torch.linspace(1.0, 0.0, num_adj_steps), persistent=False)
+        self._adj_dt = -1.0 / (num_adj_steps - 1)
     
-    def solve_adjoint_state(self, drift, x_t, t, mask):
+    def solve_adjoint_state(
+            self, drift, x_t, t, mask, pred_1, reward, analytic=False):
         """
         Solve lean adjoint ODE following HJB equation 
         Args:
-            drift: Drift function (callable)
-            x_t: Current state [batch_size, num_residues, 3]
+            drift: Drift function called as drift(x, t, pred_1, reward)
+            x_t: Current state, translations [batch_size, num_residues, 3]
+                or rotations [batch_size, num_residues, 3, 3]
             t: Current time [batch_size, 1]
             mask: Loss mask [batch_size, num_residues]
+            pred_1: Predicted clean state passed to drift
+            reward: Reward [batch_size]
+            analytic: If True, solve the adjoint of the translation or rotation
+                drift in closed form and return [batch_size, num_residues, 1].
+
+        Residues are assumed to drift independently, so the Jacobian of the
+        drift is block diagonal and each step applies the exact exponential
+        of a per-residue 3x3 block. This stays stable at large rewards and
+        agrees with the closed form for translations.
         """
-        # Initialize at terminal time with proper final condition
-        a_t = -torch.ones_like(x_t)  # [batch_size, num_residues, 3]
-        a_t = a_t * mask[..., None]  # Apply mask while keeping dimensions
-
         # Backward integration timesteps
-        timesteps = torch.linspace(1.0, 0.0, 20, device=a_t.device)
-        dt = timesteps[1] - timesteps[0]
-
-        curr_x = x_t.clone()
-        adjoint_states = [a_t]
+        timesteps = self._adj_ts
+        dt = self._adj_dt
+
+        if analytic:
+            # Both drifts scale the adjoint by a per-sample scalar at every
+            # step, so the adjoint ODE reduces to a [batch_size] recurrence.
+            if drift is _trans_drift_fn:
+                scale = _trans_adjoint_scale(reward, timesteps, dt)
+            elif drift is _rot_drift_fn:
+                scale = _rot_adjoint_scale(reward, timesteps, dt)
+            else:
+                raise ValueError(f'No closed form adjoint for drift {drift}')
+            a_t = -mask[..., None] * scale.view(-1, 1, 1)  # [batch_size, num_residues, 1]
+            torch._assert_async(torch.all(torch.isfinite(a_t)))
+            return a_t
 
-        # Backward integration of HJB adjoint equation
-        for t_curr, t_next in zip(timesteps[:-1], timesteps[1:]):
-            # Match time dimensions with batch
-            t_curr = t_curr.expand_as(t)  # [batch_size, 1]
+        # Initialize at terminal time with proper final condition. The
+        # adjoint lives in the tangent space, [batch_size, num_residues, 3]
+        # for both translations and rotations.
+        a_t = -mask[..., None] * x_t.new_ones(3)
+        rotations = x_t.dim() == mask.dim() + 2
 
-            # Compute drift with proper broadcasting
-            curr_drift = drift(curr_x, t_curr) * mask[..., None]  # [batch_size, num_residues, 3]
+        curr_x = x_t.detach()
 
-            # Get drift gradient w.r.t state
-            grad_b = torch.autograd.grad(
-                curr_drift.sum(), curr_x,  
-                create_graph=True, retain_graph=True
-            )[0]  # [batch_size, num_residues, 3, 3]
+        # Evaluate the drift at interval midpoints, which keeps the
+        # 1 / (1 - t) of the translation drift away from t = 1.
+        t_mids = timesteps[:-1] + 0.5 * dt
+        t_mids = t_mids.view(-1, 1, 1).expand(-1, *t.shape)  # [num_steps - 1, batch_size, 1]
 
-            # HJB adjoint equation discretization
-            a_t = a_t - dt * torch.einsum('...ijm,...j->...i', grad_b, a_t)  
+        # Backward integration of HJB adjoint equation
+        for t_curr in t_mids.to(t.dtype):
+            # Perturb the state along its tangent space. For rotations
+            # r (I + [w]_x) matches r exp([w]_x) to first order at w = 0.
+            with torch.enable_grad():
+                w = torch.zeros_like(a_t, requires_grad=True)
+                if rotations:
+                    x = curr_x + so3_utils.rot_mult(
+                        curr_x, so3_utils.vector_to_skew_matrix(w))
+                else:
+                    x = curr_x + w
+                curr_drift = drift(x, t_curr, pred_1, reward) * mask[..., None]  # [batch_size, num_residues, 3]
+
+            # Per-residue Jacobian db/dx, one vector-Jacobian product per row
+            jac = torch.stack([
+                torch.autograd.grad(
+                    curr_drift[..., k], w,
+                    grad_outputs=torch.ones_like(curr_drift[..., k]),
+                    retain_graph=True,
+                    create_graph=self.training
+                )[0]
+                for k in range(3)
+            ], dim=-2)  # [batch_size, num_residues, 3, 3]
+
+            # Exponential step of the HJB adjoint equation da/dt = -a^T db/dx
+            a_t = torch.einsum(
+                'bni,bnij->bnj', a_t, torch.linalg.matrix_exp(-dt * jac))
             a_t = a_t * mask[..., None]
-            adjoint_states.append(a_t)
 
             # Update state with controlled dynamics
             with torch.no_grad():
-                dx = dt * curr_drift
-                curr_x = curr_x + dx
+                if rotations:
+                    curr_x = so3_utils.rot_mult(
+                        curr_x, so3_utils.rotvec_to_rotmat(dt * curr_drift))
+                else:
+                    curr_x = curr_x + dt * curr_drift
 
-        return adjoint_states[-1]
+        torch._assert_async(torch.all(torch.isfinite(a_t)))
+        return a_t
 
     @property
     def checkpoint_dir(self):
@@ -140,8 +245,9 @@ class FlowModule(LightningModule):
     def model_step(self, noisy_batch: Any):
         training_cfg = self._exp_cfg.training
         loss_mask = noisy_batch['res_mask'] * noisy_batch['diffuse_mask'] 
-        if torch.any(torch.sum(loss_mask, dim=-1) < 1):
-            raise ValueError('Empty batch encountered')
+        loss_mask_sum = torch.sum(loss_mask, dim=-1)
+        # Fails on device for an empty batch without a host sync.
+        torch._assert_async(torch.all(loss_mask_sum >= 1))
 
         # Get model predictions
         model_output = self.model(noisy_batch)
@@ -152,14 +258,22 @@ class FlowModule(LightningModule):
         # Convert predictions to atom positions for validity check
         pred_bb_atoms = all_atom.to_atom37(pred_trans_1, pred_rotmats_1)[:, :, :3]
 
-        bond_lengths = torch.norm(pred_bb_atoms[:,:,1:] - pred_bb_atoms[:,:,:-1], dim=-1)
-        valid_bonds = torch.logical_and(bond_lengths > 1.0, bond_lengths < 2.0) # Reasonable bond length range in Angstroms
-        validity_reward = valid_bonds.float().mean(dim=-1)
+        bond_vecs = pred_bb_atoms[:,:,1:] - pred_bb_atoms[:,:,:-1]
+        sq_bond_lengths = torch.sum(bond_vecs * bond_vecs, dim=-1)
+        valid_bonds = torch.logical_and(sq_bond_lengths > 1.0, sq_bond_lengths < 4.0) # Bond lengths in (1, 2) Angstroms
+        validity_reward = valid_bonds.flatten(1).sum(
+            dim=-1, dtype=torch.float32) / valid_bonds[0].numel()
 
         batch_size = pred_bb_atoms.shape[0]
         flat_coords = pred_bb_atoms.reshape(batch_size, -1, 3)
+        num_samples = training_cfg.diversity_reward_samples
+        if num_samples is not None and flat_coords.shape[1] > num_samples:
+            # Estimate the mean pairwise distance from a random subset of atoms.
+            sample_idx = torch.randperm(
+                flat_coords.shape[1], device=flat_coords.device)[:num_samples]
+            flat_coords = flat_coords[:, sample_idx]
 
-        pairwise_dists = torch.cdist(flat_coords, flat_coords)
+        pairwise_dists = mu.calc_pairwise_dists(flat_coords)
 
         diversity_reward = pairwise_dists.mean(dim=(-1,-2))
 
@@ -172,66 +286,55 @@ class FlowModule(LightningModule):
         r3_t = noisy_batch['r3_t']
         so3_t = noisy_batch['so3_t']
 
-        # Compute memoryless noise schedule
-        alpha_t = r3_t
-        beta_t = 1 - r3_t
-        alpha_dot = torch.ones_like(r3_t) 
-        beta_dot = -torch.ones_like(r3_t)
-        eta_t = beta_t * (alpha_dot/alpha_t * beta_t - beta_dot)
-        sigma_t = torch.sqrt(2 * eta_t)
+        # Compute memoryless noise schedule. With alpha_t = t and beta_t = 1 - t,
+        # eta_t = beta_t * (alpha_dot / alpha_t * beta_t - beta_dot) = (1 - t) / t.
+        sigma_t = torch.sqrt(2.0 * (1.0 - r3_t) / r3_t.clamp_min(1e-6)).view(-1, 1, 1)
 
         # Scale losses by reward
-        def trans_drift(x, t):
-            return (pred_trans_1 - x) / (1 - t[..., None]) * reward[..., None, None]
-
         trans_adjoint = self.solve_adjoint_state(
-            trans_drift, trans_t, r3_t, loss_mask)
+            _trans_drift_fn, trans_t, r3_t, loss_mask, pred_trans_1, reward,
+            analytic=training_cfg.use_analytic_adjoint)
 
-        trans_vf = trans_drift(trans_t, r3_t)
-        trans_adjoint_term = trans_vf + sigma_t[..., None, None] * trans_adjoint
+        trans_vf = _trans_drift_fn(trans_t, r3_t, pred_trans_1, reward)
+        trans_adjoint_term = trans_vf + sigma_t * trans_adjoint
 
-        trans_loss = training_cfg.translation_loss_weight * torch.sum(
-            trans_adjoint_term**2 * loss_mask[..., None],
-            dim=(-1, -2)
-        ) / torch.sum(loss_mask, dim=-1)
+        trans_loss = training_cfg.translation_loss_weight * torch.einsum(
+            'bnd,bn->b', trans_adjoint_term * trans_adjoint_term, loss_mask
+        ) / loss_mask_sum
         trans_loss = torch.clamp(trans_loss, max=5)
 
-        def rot_drift(r, t):
-            return so3_utils.calc_rot_vf(r, pred_rotmats_1) * reward[..., None, None]
-
         rot_adjoint = self.solve_adjoint_state(
-            rot_drift, rotmats_t, so3_t, loss_mask)
+            _rot_drift_fn, rotmats_t, so3_t, loss_mask, pred_rotmats_1, reward,
+            analytic=training_cfg.use_analytic_adjoint)
 
-        rot_vf = rot_drift(rotmats_t, so3_t)
-        rot_sigma_t = torch.sqrt(2 * so3_t)
-        rot_adjoint_term = rot_vf + rot_sigma_t[..., None, None] * rot_adjoint
+        rot_vf = _rot_drift_fn(rotmats_t, so3_t, pred_rotmats_1, reward)
 
-        rots_vf_loss = training_cfg.rotation_loss_weights * torch.sum(
-            rot_adjoint_term**2 * loss_mask[..., None],
-            dim=(-1, -2)
-        ) / torch.sum(loss_mask, dim=-1)
+        rot_sigma_t = torch.sqrt(2.0 * so3_t).view(-1, 1, 1)
+        rot_adjoint_term = rot_vf + rot_sigma_t * rot_adjoint
+
+        rots_vf_loss = training_cfg.rotation_loss_weights * torch.einsum(
+            'bnd,bn->b', rot_adjoint_term * rot_adjoint_term, loss_mask
+        ) / loss_mask_sum
 
         # Keep auxiliary losses but scale them by reward
-        auxiliary_loss = 0.0
+        auxiliary_loss = torch.zeros_like(trans_loss)
         if training_cfg.aux_loss_weight > 0 and r3_t[0, 0] > 0.5:
             gt_bb_atoms = all_atom.to_atom37(
                 noisy_batch['trans_1'],
                 noisy_batch['rotmats_1']
             )[:, :, :3]
-
-            loss_denom = torch.sum(loss_mask, dim=-1) * 3
-            bb_atom_loss = torch.sum(
-                (gt_bb_atoms - pred_bb_atoms)**2 * loss_mask[..., None, None],
-                dim=(-1, -2, -3)
-            ) / loss_denom
+            bb_atom_diff = gt_bb_atoms - pred_bb_atoms
+            bb_atom_loss = torch.einsum(
+                'bnad,bn->b', bb_atom_diff * bb_atom_diff, loss_mask
+            ) / (loss_mask_sum * 3)
 
             auxiliary_loss = bb_atom_loss * training_cfg.aux_loss_weight * reward
             auxiliary_loss = torch.clamp(auxiliary_loss, max=5)
 
         se3_vf_loss = trans_loss + rots_vf_loss + auxiliary_loss
 
-        if torch.any(torch.isnan(se3_vf_loss)):
-            raise ValueError('NaN loss encountered')
+        # Fails on device for a NaN loss without a host sync.
+        torch._assert_async(~torch.any(torch.isnan(se3_vf_loss)))
 
         return {
             "trans_loss": trans_loss,
@@ -260,33 +363,20 @@ class FlowModule(LightningModule):
             res_idx=batch['res_idx'],
         )
         samples = atom37_traj[-1].numpy()
-        batch_metrics = []
-        for i in range(num_batch):
+
+        # Write out samples to PDB files and compute metrics.
+        for final_pos, sample_csv_idx in zip(samples, csv_idx.tolist()):
             sample_dir = os.path.join(
                 self.checkpoint_dir,
-                f'sample_{csv_idx[i].item()}_idx_{batch_idx}_len_{num_res}'
+                f'sample_{sample_csv_idx}_idx_{batch_idx}_len_{num_res}'
             )
-            os.makedirs(sample_dir, exist_ok=True)
-
-            # Write out sample to PDB file
-            final_pos = samples[i]
-            saved_path = au.write_prot_to_pdb(
-                final_pos,
-                os.path.join(sample_dir, 'sample.pdb'),
-                no_indexing=True
-            )
-            if isinstance(self.logger, WandbLogger):
+            saved_path, sample_metrics = _process_sample(
+                (final_pos, sample_dir))
+            if isinstance(self.logger, WandbLogger) and self.global_rank == 0:
                 self.validation_epoch_samples.append(
                     [saved_path, self.global_step, wandb.Molecule(saved_path)]
                 )
-
-            mdtraj_metrics = metrics.calc_mdtraj_metrics(saved_path)
-            ca_idx = residue_constants.atom_order['CA']
-            ca_ca_metrics = metrics.calc_ca_ca_metrics(final_pos[:, ca_idx])
-            batch_metrics.append((mdtraj_metrics | ca_ca_metrics))
-
-        batch_metrics = pd.DataFrame(batch_metrics)
-        self.validation_epoch_metrics.append(batch_metrics)
+            self.validation_epoch_metrics.append(sample_metrics)
         
     def on_validation_epoch_end(self):
         if len(self.validation_epoch_samples) > 0:
@@ -295,7 +385,7 @@ class FlowModule(LightningModule):
                 columns=["sample_path", "global_step", "Protein"],
                 data=self.validation_epoch_samples)
             self.validation_epoch_samples.clear()
-        val_epoch_metrics = pd.concat(self.validation_epoch_metrics)
+        val_epoch_metrics = pd.DataFrame(self.validation_epoch_metrics)
         for metric_name,metric_val in val_epoch_metrics.mean().to_dict().items():
             self._log_scalar(
                 f'valid/{metric_name}',
@@ -336,6 +426,9 @@ class FlowModule(LightningModule):
         self.interpolant.set_device(batch['res_mask'].device)
         noisy_batch = self.interpolant.corrupt_batch(batch)
         if self._interpolant_cfg.self_condition and random.random() > 0.5:
+            # self.model is not the DDP-wrapped module, so this forward does not
+            # register gradient sync hooks. Lightning already skips the
+            # all-reduce on accumulating micro-batches.
             with torch.no_grad():
                 model_sc = self.model(noisy_batch)
                 noisy_batch['trans_sc'] = (
@@ -343,59 +436,55 @@ class FlowModule(LightningModule):
                     + noisy_batch['trans_1'] * (1 - noisy_batch['diffuse_mask'][..., None])
                 )
         batch_losses = self.model_step(noisy_batch)
-        num_batch = batch_losses['trans_loss'].shape[0]
+        num_batch, num_res = batch['res_mask'].shape
         total_losses = {
             k: torch.mean(v) for k,v in batch_losses.items()
         }
-        for k,v in total_losses.items():
-            self._log_scalar(
-                f"train/{k}", v, prog_bar=False, batch_size=num_batch)
-        
+        log_payload = {f"train/{k}": v for k,v in total_losses.items()}
+
         # Losses to track. Stratified across t.
-        so3_t = torch.squeeze(noisy_batch['so3_t'])
-        self._log_scalar(
-            "train/so3_t",
-            np.mean(du.to_numpy(so3_t)),
-            prog_bar=False, batch_size=num_batch)
-        r3_t = torch.squeeze(noisy_batch['r3_t'])
-        self._log_scalar(
-            "train/r3_t",
-            np.mean(du.to_numpy(r3_t)),
-            prog_bar=False, batch_size=num_batch)
-        for loss_name, loss_dict in batch_losses.items():
+        so3_t = noisy_batch['so3_t'][:, 0]
+        log_payload["train/so3_t"] = torch.mean(so3_t)
+        r3_t = noisy_batch['r3_t'][:, 0]
+        log_payload["train/r3_t"] = torch.mean(r3_t)
+
+        # Copy t and losses to host in a single transfer for stratification.
+        loss_names = list(batch_losses.keys())
+        host_values = torch.stack(
+            [so3_t, r3_t] + [batch_losses[k] for k in loss_names]
+        ).detach().cpu()
+        host_so3_t, host_r3_t = host_values[0], host_values[1]
+        for loss_name, host_loss in zip(loss_names, host_values[2:]):
             if loss_name == 'rots_vf_loss':
-                batch_t = so3_t
+                batch_t = host_so3_t
             else:
-                batch_t = r3_t
+                batch_t = host_r3_t
             stratified_losses = mu.t_stratified_loss(
-                batch_t, loss_dict, loss_name=loss_name)
+                batch_t, host_loss, loss_name=loss_name)
             for k,v in stratified_losses.items():
-                self._log_scalar(
-                    f"train/{k}", v, prog_bar=False, batch_size=num_batch)
+                log_payload[f"train/{k}"] = v
 
         # Training throughput
-        scaffold_percent = torch.mean(batch['diffuse_mask'].float()).item()
-        self._log_scalar(
-            "train/scaffolding_percent",
-            scaffold_percent, prog_bar=False, batch_size=num_batch)
+        log_payload["train/scaffolding_percent"] = torch.mean(
+            batch['diffuse_mask'].float())
         motif_mask = 1 - batch['diffuse_mask'].float()
         num_motif_res = torch.sum(motif_mask, dim=-1)
-        self._log_scalar(
-            "train/motif_size", 
-            torch.mean(num_motif_res).item(), prog_bar=False, batch_size=num_batch)
-        self._log_scalar(
-            "train/length", batch['res_mask'].shape[1], prog_bar=False, batch_size=num_batch)
-        self._log_scalar(
-            "train/batch_size", num_batch, prog_bar=False)
+        log_payload["train/motif_size"] = torch.mean(num_motif_res)
+        log_payload["train/length"] = num_res
+        log_payload["train/batch_size"] = num_batch
         step_time = time.time() - step_start_time
-        self._log_scalar(
-            "train/examples_per_second", num_batch / step_time)
+        log_payload["train/examples_per_second"] = num_batch / step_time
+        self.log_dict(
+            log_payload,
+            on_step=True,
+            on_epoch=False,
+            prog_bar=False,
+            batch_size=num_batch,
+            rank_zero_only=True
+        )
         train_loss = total_losses['se3_vf_loss']
         self._log_scalar(
             "train/loss", train_loss, batch_size=num_batch)
-        self._log_scalar("train/diversity_reward", torch.mean(batch_losses['diversity_reward']), batch_size=num_batch)
-        self._log_scalar("train/validity_reward", torch.mean(batch_losses['validity_reward']), batch_size=num_batch) 
-        self._log_scalar("train/total_reward", torch.mean(batch_losses['total_reward']), batch_size=num_batch)
         return train_loss
 
     def configure_optimizers(self):
@@ -440,7 +529,8 @@ class FlowModule(LightningModule):
             trans_1=trans_1, rotmats_1=rotmats_1, diffuse_mask=diffuse_mask
         )
 
-        bb_trajs = du.to_numpy(torch.stack(atom37_traj, dim=0).transpose(0, 1))
+        bb_trajs = du.to_numpy(torch.stack(atom37_traj, dim=1))
+        model_trajs = du.to_numpy(torch.flip(torch.cat(model_traj, dim=0), dims=[0]))
         for i in range(num_batch):
             sample_dir = sample_dirs[i]
             bb_traj = bb_trajs[i]
@@ -452,7 +542,7 @@ class FlowModule(LightningModule):
             _ = eu.save_traj(
                 bb_traj[-1],
                 bb_traj,
-                np.flip(du.to_numpy(torch.concat(model_traj, dim=0)), axis=0),
+                model_trajs,
                 du.to_numpy(diffuse_mask)[0],
                 output_dir=sample_dir,
                 aatype=aatype,
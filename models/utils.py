@@ -18,6 +18,36 @@ def calc_distogram(pos, min_bin, max_bin, num_bins):
     return dgram
 
 
+def calc_pairwise_dists(pos):
+    """Euclidean distances between all points of pos [B, K, D].
+
+    Uses |x - y|^2 = |x|^2 + |y|^2 - 2 x.y so the bulk of the work is a
+    single batched matmul instead of torch.cdist. Under autocast the matmul
+    runs in bfloat16 while the norms and their sum stay in float32.
+    """
+    device_type = pos.device.type
+    try:
+        autocast_enabled = torch.is_autocast_enabled(device_type)
+    except TypeError:
+        # torch < 2.4 takes no device type and only reports CUDA autocast.
+        autocast_enabled = (
+            torch.is_autocast_cpu_enabled() if device_type == 'cpu'
+            else torch.is_autocast_enabled())
+    if autocast_enabled:
+        with torch.autocast(device_type=device_type, enabled=False):
+            pos = pos.float()
+            sq_norm = pos.pow(2).sum(-1, keepdim=True)
+            pos_bf16 = pos.to(torch.bfloat16)
+            gram = torch.bmm(pos_bf16, pos_bf16.transpose(-1, -2)).float()
+            sq_dists = (sq_norm + sq_norm.transpose(-1, -2)).sub_(gram, alpha=2)
+            return sq_dists.clamp_min_(1e-30).sqrt_()
+    sq_norm = pos.pow(2).sum(-1, keepdim=True)
+    sq_dists = torch.baddbmm(
+        sq_norm, pos, pos.transpose(-1, -2), alpha=-2
+    ).add_(sq_norm.transpose(-1, -2))
+    return sq_dists.clamp_min_(1e-30).sqrt_()
+
+
 def get_index_embedding(indices, embed_size, max_len=2056):
     """Creates sine / cosine positional embeddings from a prespecified indices.
 